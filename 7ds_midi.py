@@ -1,94 +1,189 @@
 # Copyright (c) 2020 /u/Provalist
 
 import argparse
-from collections import OrderedDict
+import heapq
+import io
+import sys
+from bisect import bisect_right
+from functools import lru_cache
 
+import numpy as np
 from mido import MidiFile, merge_tracks
 
-
-class Note:
-    _PITCHES = [
-        'C', 'C#', # Meliodas
-        'D', 'D#', # Diane
-        'E',       # Ban
-        'F', 'F#', # King
-        'G', 'G#', # Gowther
-        'A', 'A#', # Merlin
-        'B'        # Escanor
-    ]
-
-    def __init__(self, msg, start, duration, disable_vel=False):
-        self.note_value = msg.note
-        self.pitch = self._PITCHES[msg.note % 12]
-
-        self.octave = msg.note // 12 - 1 # Divide by 12 to get the octave. Translate down by 1 too.
-        self.start = start # Time (in sixteenth notes) since the beginning of the track that this note starts on
-        self.duration = duration # Duration of the note in sixteenth notes
-        self.velocity = 12 if disable_vel else round(msg.velocity * (16/128)) # Note velocity, linearly scaled from 0-127 to 0-15
-
-    def _get_length_str(self, duration):
-        assert duration >= 1, f"Error: Note duration was less than a sixteenth note. ({duration})"
-
-        d = OrderedDict()
-        d[1] = '16' # 1
-        d[2] = '8' # 2 = 1 eighth note
-        d[3] = '8.' # 3 = 1.5 eighth = dotted eighth
-        d[4] = '' # 4 = quarter note = blank by default
-        d[6] = '4.' # 6 = 1.5 quarter = dotted quarter
-        d[8] = '2' # 8 = half note
-        d[12] = '2.' # 12 = 1.5 half = dotted half
-        d[16] = '1' # 16 = whole note
-        d[24] = '1.' # 24 = 1.5 whole = dotted whole
-        result = d.get(duration)
-
-        if not result:
-            # Find the largest known unit in the dict and append it to the result.
-            low = None
-            for key in reversed(d):
-                if key < duration:
-                    low = key
-                    break
-
-            # Take remaining duration and recursively append the rest.
-            return d[low] + f'&{self.pitch}' + self._get_length_str(duration - low)
-
-        return result
-
-    def encode(self):
-        if self.duration <= 0: return '' # Note with 0 duration. Happens sometimes I guess. Just ignore it.
-        result = ''
-
-        # Add velocity
-        if self.velocity != 12: result += 'V' + str(self.velocity)
-
-        # Add octave information
-        result += 'O' + str(self.octave)
-
-        # Add pitch (note symbol)
-        result += self.pitch
-
-        # Add the length of the note
-        result += self._get_length_str(self.duration)
-
-        return result
-
-    @property
-    def end(self):
-        return self.start + self.duration
-
-
-class Rest(Note):
-    def __init__(self, start, duration):
-        self.pitch = 'R' # It means Rest. Pretty easy to figure out tbh
-        self.start = start # See Note.start
-        self.duration = duration # See Note.duration
-
-    def encode(self):
-        return self.pitch + self._get_length_str(self.duration)
-
-    @property
-    def end(self):
-        return self.start + self.duration
+# Message type codes for the extracted event arrays
+_OTHER, _NOTE_ON, _NOTE_OFF = 0, 1, 2
+
+# Overlapping notes on the same pitch get a stack this deep; anything weirder
+# than 32 simultaneous copies of one pitch gets dropped.
+_MAX_STACK = 32
+
+
+def _pair_notes(times, types, notes, velocities):
+    """ Match note_on events with their note_offs and return parallel arrays
+        of (start, duration, note, velocity), one entry per completed note in
+        note_off order. Deliberately pure numeric array code with no Python
+        objects, so numba can compile it to machine code when available.
+        Overlapping notes on the same pitch pair up LIFO, same as the old
+        dict-of-stacks did. Unmatched note_offs are ignored. """
+    n = times.shape[0]
+    heads = np.zeros(128, dtype=np.int32) # per-pitch stack depth
+    stack_starts = np.empty((128, _MAX_STACK), dtype=np.int32)
+    stack_vels = np.empty((128, _MAX_STACK), dtype=np.int32)
+
+    starts = np.empty(n, dtype=np.int32)
+    durations = np.empty(n, dtype=np.int32)
+    out_notes = np.empty(n, dtype=np.int32)
+    out_vels = np.empty(n, dtype=np.int32)
+
+    count = 0
+    for i in range(n):
+        mtype = types[i]
+        if mtype == _NOTE_ON:
+            pitch = notes[i]
+            depth = heads[pitch]
+            if depth < _MAX_STACK:
+                stack_starts[pitch, depth] = times[i]
+                stack_vels[pitch, depth] = velocities[i]
+                heads[pitch] = depth + 1
+        elif mtype == _NOTE_OFF:
+            pitch = notes[i]
+            depth = heads[pitch] - 1
+            if depth >= 0:
+                heads[pitch] = depth
+                starts[count] = stack_starts[pitch, depth]
+                durations[count] = times[i] - stack_starts[pitch, depth]
+                out_notes[count] = pitch
+                out_vels[count] = stack_vels[pitch, depth]
+                count += 1
+
+    return starts[:count], durations[:count], out_notes[:count], out_vels[:count]
+
+
+def _pair_notes_py(times, types, notes, velocities):
+    """ Pure-Python version of _pair_notes for when numba isn't installed.
+        Indexing numpy scalars from an interpreted loop is slow, so this works
+        on plain lists instead. Open notes live in a 128-slot table rather
+        than a dict: in practice a pitch almost never overlaps itself, so the
+        common case is one (start, velocity) tuple per slot, and the rare
+        overlap promotes the slot to a list (still popped LIFO). """
+    times = times.tolist()
+    notes = notes.tolist()
+    velocities = velocities.tolist()
+
+    open_notes = [None] * 128
+    starts = []
+    durations = []
+    out_notes = []
+    out_vels = []
+
+    for i, mtype in enumerate(types.tolist()):
+        if mtype == _NOTE_ON:
+            pitch = notes[i]
+            slot = open_notes[pitch]
+            entry = (times[i], velocities[i])
+            if slot is None:
+                open_notes[pitch] = entry
+            elif type(slot) is list:
+                slot.append(entry)
+            else:
+                open_notes[pitch] = [slot, entry]
+        elif mtype == _NOTE_OFF:
+            pitch = notes[i]
+            slot = open_notes[pitch]
+            if slot is None:
+                continue # unmatched note_off
+            if type(slot) is list:
+                start, velocity = slot.pop()
+                if not slot:
+                    open_notes[pitch] = None
+            else:
+                start, velocity = slot
+                open_notes[pitch] = None
+            starts.append(start)
+            durations.append(times[i] - start)
+            out_notes.append(pitch)
+            out_vels.append(velocity)
+
+    return (np.array(starts, dtype=np.int32),
+            np.array(durations, dtype=np.int32),
+            np.array(out_notes, dtype=np.int32),
+            np.array(out_vels, dtype=np.int32))
+
+
+try:
+    # Optional: numba compiles the array pairing loop to machine code.
+    # Everything still works without it via the plain-Python version.
+    from numba import njit
+    _pair_notes = njit(cache=True)(_pair_notes)
+except ImportError:
+    _pair_notes = _pair_notes_py
+
+# Note-length symbols as parallel sorted tuples (duration in sixteenth notes
+# and its symbol), so the encoder bisects and indexes instead of hashing.
+_DUR_KEYS = (1, 2, 3, 4, 6, 8, 12, 16, 24)
+_DUR_SYMS = (
+    '16', # 1
+    '8',  # 2 = 1 eighth note
+    '8.', # 3 = 1.5 eighth = dotted eighth
+    '',   # 4 = quarter note = blank by default
+    '4.', # 6 = 1.5 quarter = dotted quarter
+    '2',  # 8 = half note
+    '2.', # 12 = 1.5 half = dotted half
+    '1',  # 16 = whole note
+    '1.', # 24 = 1.5 whole = dotted whole
+)
+
+_PITCHES = [
+    'C', 'C#', # Meliodas
+    'D', 'D#', # Diane
+    'E',       # Ban
+    'F', 'F#', # King
+    'G', 'G#', # Gowther
+    'A', 'A#', # Merlin
+    'B'        # Escanor
+]
+
+# Every possible 'O<octave><pitch>' prefix, indexed by raw MIDI note number,
+# so encoding a note never has to format the octave/pitch itself.
+_NOTE_PREFIX = [f'O{n // 12 - 1}{_PITCHES[n % 12]}' for n in range(128)]
+
+# Same idea for velocities. Scaled velocities run 0-16 (127 rounds up to 16).
+_VEL_STR = [f'V{v}' for v in range(17)]
+
+
+@lru_cache(maxsize=4096)
+def _length_str(duration, pitch):
+    """ Get the length string for a duration (in sixteenths). Durations that
+        aren't a single known unit get split into tied sub-notes, which is why
+        the pitch is needed too. Durations repeat constantly within a song, so
+        the results are memoized. """
+    assert duration >= 1, f"Error: Note duration was less than a sixteenth note. ({duration})"
+
+    pieces = []
+    while True:
+        # Largest known unit that fits in the duration
+        i = bisect_right(_DUR_KEYS, duration) - 1
+        key = _DUR_KEYS[i]
+        sym = _DUR_SYMS[i]
+
+        if key == duration:
+            if sym:
+                pieces.append(sym)
+                break
+            # The quarter note's symbol is blank (falsy), so exact quarters
+            # deliberately fall through and split into dotted-eighth plus
+            # sixteenth, just like the old dict lookup did.
+            i -= 1
+            key = _DUR_KEYS[i]
+            sym = _DUR_SYMS[i]
+
+        # Emit the unit as a tied sub-note and keep going with what's left.
+        # Collecting pieces in a list and joining once avoids quadratic
+        # string concatenation on long tied notes.
+        pieces.append(sym + f'&{pitch}')
+        duration -= key
+
+    return ''.join(pieces)
 
 
 class Track:
@@ -96,87 +191,179 @@ class Track:
         self.track = track # Mido track object
         self.tpb = ticks_per_beat * speed_mult # Time ticks per beat. Speed mult > 1 goes faster and < 1 goes slower.
         self._disable_vel = disable_vel
+        # Pick the note writer once here instead of branching on disable_vel
+        # for every single note in the encoding loop
+        self._append_note = Line.append_no_vel if disable_vel else Line.append
+        # When the scaled tpb is a whole number (the usual case), the tick
+        # conversion can stay in exact integer math.
+        self._tpb_int = int(self.tpb) if self.tpb == int(self.tpb) else None
 
     @staticmethod
-    def _get_available_line(lines, note):
-        """ Gets the most recent available line for a note. "Available" here
-            means the start of the note is after the end of the line, so the
-            whole line is linearly sequential. If no line is available, a
-            new one will be added. """
-        for line in reversed(lines):
-            if line.end <= note.start:
-                return line
+    def _get_available_line(lines, heap, start):
+        """ Gets an available line for a note starting at `start`. "Available"
+            here means the start of the note is after the end of the line, so
+            the whole line is linearly sequential. The heap is keyed on line
+            end time, so the earliest-ending line is the best possible
+            candidate (classic interval partitioning). If no line is
+            available, a new one will be added. Either way the line comes back
+            popped, as a (number, line) pair; the caller pushes it again once
+            the note is appended and the end time has moved. The number is the
+            line's creation order and breaks ties between lines ending at the
+            same time. """
+        while heap:
+            end, num, line = heap[0]
+            if end != line.end:
+                # Stale entry: the line grew via the fast path in encode since
+                # it was pushed. Refresh its key and look again.
+                heapq.heapreplace(heap, (line.end, num, line))
+                continue
+            if end <= start:
+                heapq.heappop(heap)
+                return num, line
+            break
 
         # No available line found
-        new_line = Line(note.start)
+        new_line = Line()
         lines.append(new_line)
-        return new_line
-
-    def encode(self):
-        result = ''
-
-        durations = {}
-        lines = []
-        time = 0
+        return len(lines) - 1, new_line
+
+    def _extract_events(self):
+        """ Walk the mido track once and pull everything the encoder needs out
+            into flat arrays, so the hot loops never touch a Message object
+            again (mido attribute access is slow). Returns absolute times in
+            sixteenth notes plus per-message type/note/velocity lists. """
+        deltas = []
+        types = []
+        notes = []
+        velocities = []
 
         for msg in self.track:
-            time += self._tick_to_sixteenth(msg.time)  # increase global time counter
-            # Increase duration for all active notes
-            for k in durations:
-                for note in durations[k]:
-                    note.duration += self._tick_to_sixteenth(msg.time)
-
-            if msg.type in ('note_on', 'note_off'): # Ignore all other message types. I dunno if they're actually useful.
-                if msg.type == 'note_on' and msg.velocity > 0: # some midi files use note_on with velocity = 0 to mean note_off
-                    # Note on
-                    if msg.note not in durations:
-                        durations[msg.note] = []
-                    durations[msg.note].append(Note(msg, time, 0, disable_vel=self._disable_vel))
-                else:
-                    # Note off
-                    note = durations[msg.note].pop()
-                    self._get_available_line(lines, note).append(note)
+            deltas.append(msg.time)
+            if msg.type == 'note_on' and msg.velocity > 0:
+                types.append(_NOTE_ON)
+                notes.append(msg.note)
+                velocities.append(msg.velocity)
+            elif msg.type in ('note_on', 'note_off'): # some midi files use note_on with velocity = 0 to mean note_off
+                types.append(_NOTE_OFF)
+                notes.append(msg.note)
+                velocities.append(0)
+            else: # Ignore all other message types. I dunno if they're actually useful.
+                types.append(_OTHER)
+                notes.append(0)
+                velocities.append(0)
+
+        # Convert tick deltas to absolute sixteenth-note times in one
+        # vectorized cumsum instead of a rounded division per message. Grand
+        # cross does not support less than 16th notes for some reason.
+        # *angry triplet noises*
+        ticks = np.cumsum(np.array(deltas, dtype=np.int64))
+        if self._tpb_int is not None:
+            # Rounded division in pure integer math: no float round-trip per
+            # event and no ULP surprises.
+            tpb = self._tpb_int
+            times = ((ticks * 4 + tpb // 2) // tpb).astype(np.int32)
+        else:
+            times = np.round(ticks * 4 / self.tpb).astype(np.int32)
+
+        types = np.array(types, dtype=np.uint8)
+        notes = np.array(notes, dtype=np.uint8)
+        velocities = np.array(velocities, dtype=np.uint8)
+
+        # The other messages only mattered for the cumsum above; drop them now
+        # so the pairing loop runs over actual note events instead of stepping
+        # past control/meta noise one row at a time. DAW exports are often
+        # mostly that noise.
+        note_mask = types != _OTHER
+        if not note_mask.all():
+            times = times[note_mask]
+            types = types[note_mask]
+            notes = notes[note_mask]
+            velocities = velocities[note_mask]
+
+        return times, types, notes, velocities
+
+    def _build_lines(self):
+        starts, durations, note_values, velocities = _pair_notes(*self._extract_events())
 
-        # Encode all lines and join them with a comma
-        result += ','.join(line.encode() for line in lines)
-
-        return result
-
-    def _tick_to_sixteenth(self, ticks):
-        """ Convert a number of ticks into an equivalent number of sixteenth notes,
-            roughly. Grand cross does not support less than 16th notes for some reason.
-            *angry triplet noises* """
-        return round((ticks / self.tpb) * 4)
-
-class Line(list):
-    def __init__(self, start):
-        super().__init__()
-        self.start = start
-        self.duration = 0
-        # If the line doesn't start at the beginning, add a rest from the beginning
-        # to the start of the line
-        if start > 0:
-            super().append(Rest(0, start))
-
-    def append(self, note):
-        if note.start > self.end:
-            # Space between notes in this line, add a rest between them.
-            super().append(Rest(self.end, note.start - self.end))
-            self.duration += note.start - self.end
-
-        # Add note to the line
-        super().append(note)
-
-        # Increase line duration
-        self.duration += note.duration
+        lines = []
+        heap = [] # min-heap of (end, line number, line), so the earliest-ending line pops first
+
+        # Scale all velocities from 0-127 to 0-16 in one vectorized pass
+        if self._disable_vel:
+            scaled_vels = [12] * len(velocities)
+        else:
+            scaled_vels = np.round(velocities * (16/128)).astype(np.int32).tolist()
+
+        append_note = self._append_note
+        last_line = None # most recently used line; melodies are sequential, so it usually fits
+        for start, duration, note_value, velocity in zip(
+                starts.tolist(), durations.tolist(), note_values.tolist(), scaled_vels):
+            if last_line is not None and last_line.end <= start:
+                # Fast path: append without touching the heap. Its entry for
+                # this line goes stale and gets refreshed lazily on the next
+                # real line search.
+                append_note(last_line, start, duration, note_value, velocity)
+            else:
+                num, line = self._get_available_line(lines, heap, start)
+                append_note(line, start, duration, note_value, velocity)
+                heapq.heappush(heap, (line.end, num, line))
+                last_line = line
+
+        return lines
+
+    def encode_iter(self):
+        """ Yield the encoded track one line at a time (with separators), so
+            big songs can be streamed out instead of held in one string. """
+        sep = ''
+        for line in self._build_lines():
+            yield sep + line.buf.getvalue()
+            sep = ','
 
     def encode(self):
-        # Encode all notes
-        return ''.join(note.encode() for note in self)
-
-    @property
-    def end(self):
-        return self.start + self.duration
+        # Encode all lines and join them with a comma
+        return ''.join(self.encode_iter())
+
+class Line:
+    """ One comma-separated line of the output. Notes used to be collected as
+        Note/Rest objects and encoded afterwards, but every note was visited
+        exactly once anyway, so now its MML token is written straight into the
+        line's string buffer as it's assigned. All that's left of the line is
+        the buffer and the time it currently ends at. """
+    __slots__ = ('buf', 'end')
+
+    def __init__(self):
+        self.buf = io.StringIO()
+        self.end = 0 # A fresh line "ends" at time 0, so the first append pads it with a rest from the beginning
+
+    def append(self, start, duration, note_value, velocity):
+        write = self.buf.write
+        if start > self.end:
+            # Space before this note in the line, write a rest to cover it.
+            # This also handles the lead-in rest on lines that don't start at
+            # the very beginning of the song.
+            write('R' + _length_str(start - self.end, 'R'))
+
+        if duration > 0: # Notes with 0 duration happen sometimes I guess. They leave no token, just move the end.
+            if velocity != 12: write(_VEL_STR[velocity])
+            write(_NOTE_PREFIX[note_value]) # 'O<octave><pitch>'
+            write(_length_str(duration, _PITCHES[note_value % 12]))
+
+        self.end = start + duration
+
+    def append_no_vel(self, start, duration, note_value, velocity):
+        """ append minus the velocity check. When velocities are disabled
+            every note is V12 and never gets a prefix, so Track picks this
+            writer once instead of re-testing that per note. Takes (and
+            ignores) the velocity so both writers are call-compatible. """
+        write = self.buf.write
+        if start > self.end:
+            write('R' + _length_str(start - self.end, 'R'))
+
+        if duration > 0:
+            write(_NOTE_PREFIX[note_value])
+            write(_length_str(duration, _PITCHES[note_value % 12]))
+
+        self.end = start + duration
 
 class Midi:
     def __init__(self, filename, tempo, disable_vel, speed_mult):
@@ -201,11 +388,16 @@ class Midi:
             speed_mult
         )
 
+    def encode_iter(self):
+        """ Yield the encoded song in chunks. Writing the chunks straight to
+            output keeps peak memory at one line instead of the whole song. """
+        yield '7ML@' # No idea what this means. Maybe the 7 is for 7 deadly sins and ML is Macro Language?
+        if self.tempo != 120: yield 'T' + str(self.tempo) # Add tempo
+        yield from self.track.encode_iter() # Encode the combined track
+        yield ';'
+
     def encode(self):
-        result = '7ML@' # No idea what this means. Maybe the 7 is for 7 deadly sins and ML is Macro Language?
-        if self.tempo != 120: result += 'T' + str(self.tempo) # Add tempo
-        result += self.track.encode() + ';' # Encode the combined track
-        return result
+        return ''.join(self.encode_iter())
 
 
 def lmao(n):
@@ -216,23 +408,22 @@ def lmao(n):
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Convert a .midi (or .mid) file into an MML code (mostly) usable by the Jukebox in 7 Deadly Sins: Grand Cross.')
     parser.add_argument('filepath', type=str, help='Path to your midi file')
-    parser.add_argument('--tempo', '-t', type=int, help='Song tempo (BPM). Note that the tempo in the midi file may not sound the same when imported into GC.')
+    parser.add_argument('--tempo', '-t', type=int, default=120, help='Song tempo (BPM). Note that the tempo in the midi file may not sound the same when imported into GC.')
     parser.add_argument('--disable_vel', '-dv', action='store_true', help='Disables note velocity, so all notes have the same volume.')
-    parser.add_argument('--speed_mult', '-sm', type=float, help='Scale the duration of all notes. Lower than 1 = slower, greater than 1 = faster. Ex, 2.0 turns halves into quarters, quarters into eighths, etc.')
+    parser.add_argument('--speed_mult', '-sm', type=float, default=1.0, help='Scale the duration of all notes. Lower than 1 = slower, greater than 1 = faster. Ex, 2.0 turns halves into quarters, quarters into eighths, etc.')
 
     args = parser.parse_args()
-    midi = Midi(
-        args.filepath,
-        args.tempo or 120,
-        args.disable_vel or False,
-        args.speed_mult or 1.0
-    )
+    midi = Midi(args.filepath, args.tempo, args.disable_vel, args.speed_mult)
     print('Successfully loaded midi and merged tracks. Encoding now! :O')
     print("This shouldn't take more than like 5 seconds so if it feels like its taking forever you're probably fucked lmao")
     print()
-    encoded = midi.encode()
-    print(encoded)
+    # Stream the code out chunk by chunk instead of building one giant string
+    length = 0
+    for chunk in midi.encode_iter():
+        length += len(chunk)
+        sys.stdout.write(chunk)
+    sys.stdout.write('\n')
     print()
-    print(f'Character length: {len(encoded)}')
+    print(f'Character length: {length}')
     print('Note: This code is probably over 3 times longer than what is generated in-game. Be sure to import this into the game and copy it again '
           'before sharing it somewhere else. It must be under 4000 characters to be saved (it can still be imported at any length though).')